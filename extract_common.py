@@ -0,0 +1,619 @@
+# SHARED GEMINI + OCR MACHINERY FOR procurement.py AND toll_extract.py
+
+import os
+
+# tesserocr picks up the OpenMP thread limit when it loads, so set it first
+os.environ.setdefault("OMP_THREAD_LIMIT", "4")
+
+import re
+import asyncio
+import csv
+import json
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import time
+import cv2
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import AsyncIterable, AsyncIterator, Callable, List, Dict, Optional, Tuple
+from dotenv import load_dotenv
+
+from google import genai
+from google.genai import errors, types
+from pdf2image import convert_from_path
+from PIL import Image
+from tesserocr import PyTessBaseAPI, PSM
+
+# CONFIG
+
+MODEL_NAME = "gemini-2.5-flash"
+
+# Chunks are retried once against ESCALATION_MODEL_NAME when the MODEL_NAME
+# reply cannot be parsed, or when it is an empty array for a chunk of at
+# least ESCALATION_MIN_CHARS (only chunks passing a script's has_content
+# filter are sent at all, so a long one with no rows is likely a miss).
+ESCALATION_MODEL_NAME = "gemini-2.5-pro"
+ESCALATION_MIN_CHARS = 1000
+
+# Gemini calls go through the async client, which multiplexes requests over
+# one connection pool. GEMINI_CONCURRENCY caps in-flight requests; 429s from
+# a tighter quota are absorbed by the retry policy below.
+GEMINI_CONCURRENCY = 32
+
+# Batches are started in page order, at most GEMINI_WINDOW ahead of the one
+# whose rows are being written, so finished batches queued behind a slow one
+# stay bounded.
+GEMINI_WINDOW = 2 * GEMINI_CONCURRENCY
+
+# Rate-limited and server-error replies are retried with exponential backoff
+# (GEMINI_RETRY_INITIAL_DELAY seconds, doubling up to GEMINI_RETRY_MAX_DELAY)
+# instead of aborting the run.
+GEMINI_RETRY_ATTEMPTS = 6
+GEMINI_RETRY_INITIAL_DELAY = 2.0
+GEMINI_RETRY_MAX_DELAY = 60.0
+
+# pdfminer's layout analysis is pure Python and holds the GIL, so page text
+# and tables are extracted in a process pool of at most PDF_WORKERS.
+PDF_WORKERS = os.cpu_count() or 1
+
+# A script's SYSTEM_PROMPT is uploaded once as cached content and referenced
+# by name, so each request only transmits the chunk text. Gemini will not cache
+# content below a per-model token minimum; a prompt that counts under it is
+# sent inline without trying, and one the server still rejects falls back to
+# inline as well.
+PROMPT_CACHE_TTL_SECONDS = 3600
+PROMPT_CACHE_MIN_TOKENS = {
+    "gemini-2.5-flash": 1024,
+    "gemini-2.5-pro": 4096
+}
+
+# Parsed Gemini responses are kept on disk, keyed by model, prompt and chunk
+# text, so re-runs only pay for chunks that changed.
+RESPONSE_CACHE_PATH = ".gemini_cache.sqlite"
+
+# Up to BATCH_SIZE consecutive chunks, BATCH_MAX_CHARS in total (~6K
+# tokens), are sent to Gemini in a single request.
+BATCH_SIZE = 6
+BATCH_MAX_CHARS = 24000
+
+# A page with at least this many non-whitespace characters in its embedded
+# text layer is treated as born-digital and never rasterised.
+BORN_DIGITAL_MIN_CHARS = 50
+
+POPPLER_PATH = r"C:\Users\ADMIN\Downloads\Release-25.12.0-0\poppler-25.12.0\Library\bin"
+TESSDATA_PATH = r"C:\Program Files\Tesseract-OCR\tessdata"
+
+# Each tesseract engine gets OCR_THREADS OpenMP threads; running
+# cpu_count // OCR_THREADS of them at once uses every core without
+# oversubscribing.
+OCR_THREADS = int(os.environ["OMP_THREAD_LIMIT"])
+OCR_WORKERS = max(1, (os.cpu_count() or 1) // OCR_THREADS)
+
+# Pages are rendered straight to grayscale; raise OCR_DPI to 300 for
+# documents with small print.
+OCR_DPI = 200
+
+# Pages are Otsu-binarised before tesseract sees them. Dilating the text
+# helps faint scans but merges small characters, so it is off by default.
+OCR_DILATE = False
+
+# The Gemini client and the response cache are created on first use, so
+# process-pool workers (which re-import the scripts on Windows) skip them.
+_client = None
+_gemini_slots = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+# cached-content handles per (model, system prompt)
+_prompt_caches = {}
+_prompt_cache_lock = asyncio.Lock()
+
+# only ever used from the event-loop thread
+_response_cache = None
+
+# one tesseract engine per OCR worker thread
+_tess = threading.local()
+
+
+# OCR
+
+def is_born_digital(page) -> bool:
+    # digits count too: financial tables are mostly numbers
+    chars = sum(1 for c in page.chars if c.get("fontname") and c["text"].strip())
+    return chars >= BORN_DIGITAL_MIN_CHARS
+
+
+def get_tess_api() -> PyTessBaseAPI:
+    # PyTessBaseAPI is not thread-safe, but keeping one per thread means the
+    # language model is loaded once per worker instead of once per page
+    if not hasattr(_tess, "api"):
+        _tess.api = PyTessBaseAPI(path=TESSDATA_PATH, psm=PSM.SINGLE_BLOCK)
+    return _tess.api
+
+
+def binarize_image(path: str):
+    gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+
+    if OCR_DILATE:
+        # text is black on white, so eroding the image dilates the text
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2, 2))
+        binary = cv2.erode(binary, kernel)
+
+    return binary
+
+
+def ocr_range(pdf_path: str, start: int, end: int) -> Dict[int, str]:
+    # Poppler renders the whole range up front; the thread's tesseract
+    # engine then reads each page in-process.
+    api = get_tess_api()
+    texts = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        image_paths = convert_from_path(
+            pdf_path,
+            first_page=start,
+            last_page=end,
+            poppler_path=POPPLER_PATH,
+            use_pdftocairo=True,
+            dpi=OCR_DPI,
+            grayscale=True,
+            output_folder=tmp,
+            fmt="tiff",
+            thread_count=2,
+            paths_only=True
+        )
+
+        for i, path in enumerate(image_paths):
+            api.SetImage(Image.fromarray(binarize_image(path)))
+            texts[start + i] = api.GetUTF8Text()
+
+    return texts
+
+
+def ocr_pages(pdf_path: str, page_nos: List[int]) -> Dict[int, str]:
+    page_nos = sorted(page_nos)
+    if not page_nos:
+        return {}
+
+    workers = min(len(page_nos), OCR_WORKERS)
+    batch = -(-len(page_nos) // workers)
+
+    # runs of consecutive pages, capped at `batch` pages so every worker
+    # gets a share; each run is rendered and recognised by one ocr_range call
+    ranges = []
+    for page_no in page_nos:
+        if ranges and page_no == ranges[-1][1] + 1 and ranges[-1][1] - ranges[-1][0] + 1 < batch:
+            ranges[-1][1] = page_no
+        else:
+            ranges.append([page_no, page_no])
+
+    # tesserocr releases the GIL while recognising, so threads are enough
+    # to keep the engines running side by side
+    texts = {}
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for result in ex.map(lambda r: ocr_range(pdf_path, r[0], r[1]), ranges):
+            texts.update(result)
+
+    return texts
+
+
+# PAGE TEXT
+
+async def iter_page_texts(
+    pdf_path: str,
+    page_nos: List[int],
+    extract_page_payload: Callable[[str, int], Optional[str]]
+) -> AsyncIterator[Tuple[int, str]]:
+    # Yields (page_no, text) in page order as soon as each page is ready.
+    # extract_page_payload runs in the process pool and returns None for a
+    # page that needs OCR; each run of such pages is recognised together in
+    # a worker thread. Neither blocks the event loop, so Gemini requests for
+    # earlier pages keep running meanwhile.
+    loop = asyncio.get_running_loop()
+    workers = max(1, min(len(page_nos), PDF_WORKERS))
+
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        payloads = [loop.run_in_executor(ex, extract_page_payload, pdf_path, n) for n in page_nos]
+        ocr_run = []
+
+        for page_no, payload in zip(page_nos, payloads):
+            text = await payload
+            if text is None:
+                ocr_run.append(page_no)
+                continue
+
+            if ocr_run:
+                async for item in ocr_page_run(pdf_path, ocr_run):
+                    yield item
+                ocr_run = []
+
+            yield page_no, text
+
+        if ocr_run:
+            async for item in ocr_page_run(pdf_path, ocr_run):
+                yield item
+
+
+async def ocr_page_run(pdf_path: str, page_nos: List[int]) -> AsyncIterator[Tuple[int, str]]:
+    print(f"OCR on {len(page_nos)} pages")
+    texts = await asyncio.to_thread(ocr_pages, pdf_path, page_nos)
+    for page_no in page_nos:
+        yield page_no, texts.get(page_no, "")
+
+
+# BATCHING
+
+async def build_batches(chunks: AsyncIterable[Dict]) -> AsyncIterator[List[Dict]]:
+    batch, size = [], 0
+
+    async for chunk in chunks:
+        if batch and (len(batch) >= BATCH_SIZE or size + len(chunk["text"]) > BATCH_MAX_CHARS):
+            yield batch
+            batch, size = [], 0
+
+        batch.append(chunk)
+        size += len(chunk["text"])
+
+    if batch:
+        yield batch
+
+
+# SAFE JSON PARSER
+
+_CODE_FENCE_RE = re.compile(r"^\s*```[a-zA-Z]*\s*|\s*```\s*$")
+_JSON_ARRAY_RE = re.compile(r"\[\s*\{.*?\}\s*\]", re.DOTALL)
+
+
+def safe_json_parse(text: Optional[str]):
+    # Returns None when the reply cannot be parsed, so callers can tell a
+    # failure apart from a valid empty array.
+    if not text:
+        return None
+
+    # Gemini often wraps its JSON in a markdown fence despite the prompt
+    text = _CODE_FENCE_RE.sub("", text)
+
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+
+    match = _JSON_ARRAY_RE.search(text)
+    if match:
+        try:
+            return json.loads(match.group(0))
+        except json.JSONDecodeError:
+            return None
+
+    return None
+
+
+def is_row_list(value) -> bool:
+    return isinstance(value, list) and all(isinstance(r, dict) for r in value)
+
+
+# Prepended to the user content of a batched request. The system prompt
+# itself is unchanged so the cached copy serves single and batched requests
+# alike.
+BATCH_PROMPT = """
+The input contains {n} chunks, labelled CHUNK 0 to CHUNK {last}.
+Apply the rules above to each chunk independently.
+Output ONLY a JSON array with exactly {n} elements, where element i is the
+JSON array of objects extracted from CHUNK i ([] if it has none).
+"""
+
+
+# GEMINI CLIENT
+
+def get_client() -> genai.Client:
+    global _client
+    if _client is None:
+        load_dotenv()
+        _client = genai.Client(
+            api_key=os.getenv("GOOGLE_API_KEY"),
+            http_options=types.HttpOptions(
+                retry_options=types.HttpRetryOptions(
+                    attempts=GEMINI_RETRY_ATTEMPTS,
+                    initial_delay=GEMINI_RETRY_INITIAL_DELAY,
+                    max_delay=GEMINI_RETRY_MAX_DELAY,
+                    exp_base=2,
+                    http_status_codes=[408, 429, 500, 502, 503, 504]
+                )
+            )
+        )
+    return _client
+
+
+# PROMPT CACHE
+
+async def is_cacheable(system_prompt: str, model: str) -> bool:
+    # counted once per (model, prompt); the tokenizer, not a character
+    # estimate, decides whether the prompt reaches the caching minimum
+    try:
+        counted = await get_client().aio.models.count_tokens(model=model, contents=system_prompt)
+    except errors.APIError:
+        # cannot tell; let caches.create accept or reject it
+        return True
+
+    minimum = PROMPT_CACHE_MIN_TOKENS.get(model, 4096)
+    if (counted.total_tokens or 0) < minimum:
+        print(
+            f"Prompt is {counted.total_tokens} tokens, below {model}'s "
+            f"caching minimum of {minimum}; sending it inline"
+        )
+        return False
+
+    return True
+
+
+async def get_prompt_cache(system_prompt: str, model: str) -> Optional[str]:
+    # Returns None when caching is unavailable (the prompt is below the
+    # model's minimum cacheable size, or creation failed) and the prompt must
+    # be sent inline.
+    async with _prompt_cache_lock:
+        if (model, system_prompt) not in _prompt_caches:
+            cacheable = await is_cacheable(system_prompt, model)
+            _prompt_caches[model, system_prompt] = {"name": None, "expires": 0.0, "disabled": not cacheable}
+
+        entry = _prompt_caches[model, system_prompt]
+
+        if entry["disabled"]:
+            return None
+
+        if entry["name"] and time.time() < entry["expires"]:
+            return entry["name"]
+
+        try:
+            cache = await get_client().aio.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=system_prompt,
+                    ttl=f"{PROMPT_CACHE_TTL_SECONDS}s"
+                )
+            )
+        except errors.APIError as e:
+            print(f"Prompt caching unavailable for {model}, sending prompt inline: {e}")
+            entry["disabled"] = True
+            return None
+
+        # recreate a minute early rather than race the server-side expiry
+        entry["name"] = cache.name
+        entry["expires"] = time.time() + PROMPT_CACHE_TTL_SECONDS - 60
+        return cache.name
+
+
+def invalidate_prompt_cache(system_prompt: str, model: str, name: str):
+    entry = _prompt_caches.get((model, system_prompt))
+    if entry and entry["name"] == name:
+        entry["name"] = None
+
+
+def is_cache_missing(e: errors.ClientError) -> bool:
+    # an expired or deleted cache is reported as 403/404 naming CachedContent;
+    # any other client error (400, 429, ...) is not a cache problem
+    return e.code in (403, 404) and "cachedcontent" in str(e.message).lower()
+
+
+async def delete_prompt_caches():
+    # caches would otherwise outlive the run until their TTL runs out
+    for entry in _prompt_caches.values():
+        if entry["name"]:
+            try:
+                await get_client().aio.caches.delete(name=entry["name"])
+            except errors.APIError as e:
+                print(f"Could not delete prompt cache {entry['name']}: {e}")
+            entry["name"] = None
+
+
+# RESPONSE CACHE
+
+def get_response_cache() -> sqlite3.Connection:
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = sqlite3.connect(RESPONSE_CACHE_PATH)
+        _response_cache.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, rows TEXT)"
+        )
+    return _response_cache
+
+
+def response_cache_key(system_prompt: str, model: str, text: str) -> str:
+    # hashing the prompt itself means editing a script's SYSTEM_PROMPT
+    # invalidates its cached responses
+    return hashlib.sha256("\0".join([model, system_prompt, text]).encode("utf-8")).hexdigest()
+
+
+def response_cache_get(key: str) -> Optional[List[Dict]]:
+    hit = get_response_cache().execute(
+        "SELECT rows FROM responses WHERE key = ?", (key,)
+    ).fetchone()
+
+    return json.loads(hit[0]) if hit else None
+
+
+def response_cache_put(key: str, rows: List[Dict]):
+    db = get_response_cache()
+    db.execute(
+        "INSERT OR REPLACE INTO responses (key, rows) VALUES (?, ?)",
+        (key, json.dumps(rows))
+    )
+    db.commit()
+
+
+def close_response_cache():
+    global _response_cache
+    if _response_cache is not None:
+        _response_cache.close()
+        _response_cache = None
+
+
+# LLM CALL
+
+async def generate(system_prompt: str, text: str, model: str):
+    cache_name = await get_prompt_cache(system_prompt, model)
+    if not cache_name:
+        return await get_client().aio.models.generate_content(
+            model=model,
+            contents=[system_prompt, text]
+        )
+
+    try:
+        return await get_client().aio.models.generate_content(
+            model=model,
+            contents=[text],
+            config=types.GenerateContentConfig(cached_content=cache_name)
+        )
+    except errors.ClientError as e:
+        if not is_cache_missing(e):
+            raise
+
+        # cache expired or was evicted early; send this request inline and
+        # let the next one rebuild the cache
+        invalidate_prompt_cache(system_prompt, model, cache_name)
+        return await get_client().aio.models.generate_content(
+            model=model,
+            contents=[system_prompt, text]
+        )
+
+
+async def call_model(system_prompt: str, chunk: Dict, model: str) -> Optional[List[Dict]]:
+    key = response_cache_key(system_prompt, model, chunk["text"])
+    rows = response_cache_get(key)
+    if rows is not None:
+        return rows
+
+    async with _gemini_slots:
+        response = await generate(system_prompt, f"TEXT:\n{chunk['text']}", model)
+
+    rows = safe_json_parse(response.text)
+    if not is_row_list(rows):
+        # a garbled, truncated or blocked reply is not cached, so a re-run
+        # asks again; None tells the caller to escalate
+        return None
+
+    response_cache_put(key, rows)
+    return rows
+
+
+async def call_model_batch(system_prompt: str, chunks: List[Dict], model: str) -> List[Optional[List[Dict]]]:
+    keys = [response_cache_key(system_prompt, model, c["text"]) for c in chunks]
+    results = [response_cache_get(k) for k in keys]
+    pending = [i for i, rows in enumerate(results) if rows is None]
+
+    if len(pending) == 1:
+        results[pending[0]] = await call_model(system_prompt, chunks[pending[0]], model)
+
+    elif pending:
+        parts = [BATCH_PROMPT.format(n=len(pending), last=len(pending) - 1)]
+        parts += [f"CHUNK {j}:\n{chunks[i]['text']}\n---" for j, i in enumerate(pending)]
+
+        async with _gemini_slots:
+            response = await generate(system_prompt, "\n".join(parts), model)
+        parsed = safe_json_parse(response.text)
+        if not (isinstance(parsed, list) and len(parsed) == len(pending)):
+            # the reply does not line up with the chunks
+            parsed = [None] * len(pending)
+
+        failed = []
+        for i, rows in zip(pending, parsed):
+            if is_row_list(rows):
+                results[i] = rows
+                response_cache_put(keys[i], rows)
+            else:
+                failed.append(i)
+
+        # ask for each failed chunk on its own, all at once
+        retried = await asyncio.gather(*(call_model(system_prompt, chunks[i], model) for i in failed))
+        for i, rows in zip(failed, retried):
+            results[i] = rows
+
+    return results
+
+
+async def map_chunks_with_gemini(system_prompt: str, chunks: List[Dict]) -> List[List[Dict]]:
+    results = await call_model_batch(system_prompt, chunks, MODEL_NAME)
+    models = [MODEL_NAME] * len(chunks)
+
+    retry = [
+        i for i, rows in enumerate(results)
+        if rows is None or (not rows and len(chunks[i]["text"]) >= ESCALATION_MIN_CHARS)
+    ]
+    if retry:
+        escalated = await call_model_batch(system_prompt, [chunks[i] for i in retry], ESCALATION_MODEL_NAME)
+        for i, rows in zip(retry, escalated):
+            results[i] = rows or []
+            models[i] = ESCALATION_MODEL_NAME
+
+    # audit trail: which model produced each row
+    for rows, model in zip(results, models):
+        for r in rows:
+            r["extraction_model"] = model
+
+    return results
+
+
+async def map_batches(
+    system_prompt: str,
+    batches: AsyncIterable[List[Dict]]
+) -> AsyncIterator[Tuple[List[Dict], List[List[Dict]]]]:
+    # Yields (batch, rows per chunk) in input order. A deque holds at most
+    # GEMINI_WINDOW started batches; the next batch is pulled and started
+    # only after the oldest has been handed to the caller.
+    window = deque()
+
+    try:
+        async for batch in batches:
+            window.append((batch, asyncio.create_task(map_chunks_with_gemini(system_prompt, batch))))
+
+            if len(window) >= GEMINI_WINDOW:
+                batch, task = window.popleft()
+                yield batch, await task
+
+        while window:
+            batch, task = window.popleft()
+            yield batch, await task
+    finally:
+        # the caller stopped early or a batch failed
+        for _, task in window:
+            task.cancel()
+
+
+# DEDUPLICATION
+
+def row_key(r: Dict, fields: List[str]) -> int:
+    # Hashes exactly what save_output writes: keys outside `fields` are
+    # dropped and None is written as an empty field. The audit field is left
+    # out so the same fact from two models is one row.
+    return hash(tuple(
+        "" if r.get(k) is None else str(r[k])
+        for k in fields if k != "extraction_model"
+    ))
+
+
+# SAVE OUTPUT
+
+async def save_output(rows: AsyncIterable[Dict], path: str, fields: List[str]):
+    # the file is opened with the first row, so an empty run writes nothing
+    count = 0
+    f = None
+
+    try:
+        async for r in rows:
+            if f is None:
+                f = open(path, "w", newline="", encoding="utf-8")
+                writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+                writer.writeheader()
+
+            writer.writerow(r)
+            count += 1
+    finally:
+        if f is not None:
+            f.close()
+
+    if not count:
+        print("No records extracted")
+        return
+
+    print(f"Extracted {count} rows")
+    print(f"Saved to {path}")
@@ -1,21 +1,15 @@
 
 
-import os
 import re
-import json
+import asyncio
 import pdfplumber
-import pandas as pd
+from collections import OrderedDict
 from typing import List, Dict
-from dotenv import load_dotenv
-from google import genai
 
-import pytesseract
-from pdf2image import convert_from_path
-
-
-# ENV
-
-load_dotenv()
+from extract_common import (
+    build_batches, close_response_cache, delete_prompt_caches, is_born_digital,
+    iter_page_texts, map_batches, row_key, save_output
+)
 
 
 # CONFIG
@@ -23,67 +17,81 @@ load_dotenv()
 PDF_PATH = r"D:\cvliq\florida_pro\florida_p1.pdf"
 OUTPUT_CSV = "schema_extracted.csv"
 
+# CSV columns: the prompt schema plus the model that produced each row
+OUTPUT_FIELDS = [
+    "agency", "opportunity_source_type", "division", "contract_number",
+    "expected_rfp_date", "expected_rfp_year", "expected_rfp_month",
+    "min_contract_value", "max_contract_value", "contract_tags",
+    "contract_type", "contract_term", "short_description",
+    "detailed_description", "key_contact", "incumbent", "procurement_method",
+    "location", "source_url", "status", "extraction_model"
+]
+
 START_PAGE = 1
 END_PAGE = 25
 
 SOURCE_URL = "https://floridasturnpike.com/wp-content/uploads/2025/12/TPK_PRESENTATION_OF_FY_2027_CONSULTANT_PLAN.pdf"
-MODEL_NAME = "gemini-2.5-pro"
 
-POPPLER_PATH = r"C:\Users\ADMIN\Downloads\Release-25.12.0-0\poppler-25.12.0\Library\bin"
-TESSERACT_PATH = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
-pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
+# Chunks target ~1024 tokens at roughly 4 characters per token.
+CHUNK_MAX_CHARS = 4000
 
-client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+# Duplicate rows are detected against the most recent DEDUP_WINDOW row
+# hashes, keeping memory bounded on very long documents.
+DEDUP_WINDOW = 100_000
 
 
-# OCR
+# PAGE EXTRACTION
 
-def ocr_page(pdf_path, page_number):
-    images = convert_from_path(
-        pdf_path,
-        first_page=page_number,
-        last_page=page_number,
-        poppler_path=POPPLER_PATH,
-        use_pdftocairo=True
-    )
-    return pytesseract.image_to_string(images[0], config="--psm 6")
+def extract_page_payload(pdf_path, page_no):
+    # Runs in a worker process, which opens just this page of the PDF.
+    # Returns None when the page has no usable text layer and needs OCR.
+    with pdfplumber.open(pdf_path, pages=[page_no]) as pdf:
+        page = pdf.pages[0]
+
+        if not is_born_digital(page):
+            return None
+
+        return page.extract_text()
 
 
 # CHUNKING
 
-def build_chunks(text, page_no, max_chars=2000):
+def build_chunks(text, page_no, max_chars=CHUNK_MAX_CHARS):
+    # Chunks do not overlap: a repeated tail would make the model extract a
+    # half-seen opportunity a second time.
     chunks = []
-    buf = ""
+    buf = []
+    buf_len = 0
 
     for line in text.splitlines():
-        if line.strip():
-            buf += line + " "
+        if not line.strip():
+            continue
+
+        # hard-wrap only a line that would not fit in a chunk on its own
+        for i in range(0, len(line), max_chars):
+            piece = line[i:i + max_chars]
+
+            if buf and buf_len + len(piece) > max_chars:
+                chunks.append({"page": page_no, "text": " ".join(buf).strip()})
+                buf.clear()
+                buf_len = 0
 
-        if len(buf) >= max_chars:
-            chunks.append({"page": page_no, "text": buf.strip()})
-            buf = ""
+            buf.append(piece)
+            buf_len += len(piece) + 1
 
-    if buf.strip():
-        chunks.append({"page": page_no, "text": buf.strip()})
+    if buf:
+        chunks.append({"page": page_no, "text": " ".join(buf).strip()})
 
     return chunks
 
-# SAFE JSON PARSER
 
-def safe_json_parse(text):
-    try:
-        return json.loads(text)
-    except:
-        pass
+# Chunks with no dollar sign, year or contract/RFP reference (covers, blank
+# pages, contents lists) hold no procurement facts and are never sent.
+_CONTENT_RE = re.compile(r"\$|\d{4}|RFP|Contract\s*No", re.IGNORECASE)
 
-    match = re.search(r"\[\s*{.*?}\s*\]", text, re.DOTALL)
-    if match:
-        try:
-            return json.loads(match.group(0))
-        except:
-            return []
 
-    return []
+def has_content(chunk):
+    return bool(_CONTENT_RE.search(chunk["text"]))
 
 
 # NORMALIZE LIST FIELDS
@@ -145,63 +153,50 @@ Schema:
 Output ONLY valid JSON.
 """
 
-# GEMINI CALL
-
-def map_chunk_with_gemini(chunk):
-    response = client.models.generate_content(
-        model=MODEL_NAME,
-        contents=[SYSTEM_PROMPT, f"TEXT:\n{chunk['text']}"]
-    )
-    return safe_json_parse(response.text)
-
 
 # PIPELINE
 
-def run_pipeline():
-    all_rows = []
-
-    with pdfplumber.open(PDF_PATH) as pdf:
-        for page_no in range(START_PAGE, END_PAGE + 1):
-            page = pdf.pages[page_no - 1]
-
-            text = page.extract_text()
-            if not text or len(text.strip()) < 50:
-                text = ocr_page(PDF_PATH, page_no)
-
-            if not text:
-                continue
-
-            chunks = build_chunks(text, page_no)
-
-            for chunk in chunks:
-                rows = map_chunk_with_gemini(chunk)
-
-                for r in rows:
-                    r["source_url"] = SOURCE_URL
-
-                all_rows.extend(rows)
+async def run_pipeline():
+    page_nos = list(range(START_PAGE, END_PAGE + 1))
+
+    # pages, chunks and batches are produced lazily and map_batches keeps a
+    # bounded window in flight, so the first request goes out as soon as the
+    # first page is read and rows still come out in page order
+    pages = iter_page_texts(PDF_PATH, page_nos, extract_page_payload)
+    chunks = (
+        c
+        async for page_no, text in pages
+        for c in build_chunks(text or "", page_no)
+        if has_content(c)
+    )
+    seen = OrderedDict()
 
-    return all_rows
+    async for _, results in map_batches(SYSTEM_PROMPT, build_batches(chunks)):
+        for rows in results:
+            for r in normalize_rows(rows):
+                r["source_url"] = SOURCE_URL
 
+                key = row_key(r, OUTPUT_FIELDS)
+                if key in seen:
+                    seen.move_to_end(key)
+                    continue
 
-# SAVE
-def save_output(rows):
-    if not rows:
-        print("No records extracted")
-        return
+                seen[key] = None
+                if len(seen) > DEDUP_WINDOW:
+                    seen.popitem(last=False)
 
-    rows = normalize_rows(rows)
+                yield r
 
-    df = pd.DataFrame(rows)
-    df = df.drop_duplicates()
-    df.to_csv(OUTPUT_CSV, index=False)
 
-    print(f"Extracted {len(df)} rows")
-    print(f"Saved to {OUTPUT_CSV}")
+# MAIN
 
+async def main():
+    try:
+        await save_output(run_pipeline(), OUTPUT_CSV, OUTPUT_FIELDS)
+    finally:
+        await delete_prompt_caches()
+        close_response_cache()
 
-# MAIN
 
 if __name__ == "__main__":
-    data = run_pipeline()
-    save_output(data)
+    asyncio.run(main())
@@ -1,26 +1,31 @@
 # UNIVERSAL PDF → TABLE-AWARE → GEMINI → STRICT JSON → CSV
 
-import os
 import re
-import json
+import asyncio
+import io
+import csv
 import pdfplumber
-import pandas as pd
-from typing import List, Dict
-from dotenv import load_dotenv
+from collections import OrderedDict
+from typing import AsyncIterable, AsyncIterator, Dict, Optional, Tuple
 
-from google import genai
-import pytesseract
-from pdf2image import convert_from_path
+from extract_common import (
+    build_batches, close_response_cache, delete_prompt_caches, is_born_digital,
+    iter_page_texts, map_batches, row_key, save_output
+)
 
-# ENV
-
-load_dotenv()
 
 # CONFIG
 
 PDF_PATH = r"D:\cvliq\newpoer_pdf\newport4.pdf"
 OUTPUT_CSV = "schema_extracted.csv"
 
+# CSV columns: the prompt schema plus the model that produced each row
+OUTPUT_FIELDS = [
+    "asset_type", "asset", "agency", "as_at_date", "year", "period_reported",
+    "metric_type", "segment", "value", "source", "source_url",
+    "extraction_model"
+]
+
 START_PAGE = 1
 END_PAGE = 3
 
@@ -28,26 +33,12 @@ AGENCY = "New Jersey Turnpike Authority"
 ASSET_TYPE = "Toll Road"
 SOURCE_URL = "https://www.njta.gov/document/njta-traffic-revenue/"
 
-MODEL_NAME = "gemini-2.5-pro"
-
-POPPLER_PATH = r"C:\Users\ADMIN\Downloads\Release-25.12.0-0\poppler-25.12.0\Library\bin"
-TESSERACT_PATH = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
-pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
-
-client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
-
-
-# OCR FALLBACK
+# Chunks target ~1024 tokens at roughly 4 characters per token.
+CHUNK_MAX_CHARS = 4000
 
-def ocr_page(pdf_path: str, page_number: int) -> str:
-    images = convert_from_path(
-        pdf_path,
-        first_page=page_number,
-        last_page=page_number,
-        poppler_path=POPPLER_PATH,
-        use_pdftocairo=True
-    )
-    return pytesseract.image_to_string(images[0], config="--psm 6")
+# Duplicate rows are detected against the most recent DEDUP_WINDOW row
+# hashes, keeping memory bounded on very long documents.
+DEDUP_WINDOW = 100_000
 
 
 # TABLE → STRUCTURED TEXT
@@ -55,47 +46,78 @@ def ocr_page(pdf_path: str, page_number: int) -> str:
 def tables_to_text(tables):
     blocks = []
     for t in tables:
-        df = pd.DataFrame(t)
-        df = df.replace("\n", " ", regex=True)
-        blocks.append(df.to_csv(index=False))
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator="\n").writerows(
+            [(c or "").replace("\n", " ") for c in row] for row in t
+        )
+        blocks.append(buf.getvalue())
     return "\n\n".join(blocks)
 
 
-# ROW-BASED CHUNKING (CRITICAL)
+# PAGE EXTRACTION
+
+def extract_page_payload(pdf_path: str, page_no: int) -> Optional[str]:
+    # Runs in a worker process, which opens just this page of the PDF.
+    # Returns None when the page has no usable text layer and needs OCR.
+    with pdfplumber.open(pdf_path, pages=[page_no]) as pdf:
+        page = pdf.pages[0]
+
+        # tables win regardless of how much text the page has; OCR would
+        # flatten their structure
+        tables = page.extract_tables()
+        if tables:
+            return tables_to_text(tables)
+
+        if not is_born_digital(page):
+            return None
+
+        return page.extract_text()
+
+
+# TABLE-AWARE CHUNKING (CRITICAL)
+
+def build_chunks(text: str, page_no: int, max_chars=CHUNK_MAX_CHARS):
+    # Whole tables (blank-line separated) are packed together first; a table
+    # that does not fit is split between rows, and only a single row longer
+    # than the budget is hard-wrapped. Chunks do not overlap, since a repeated
+    # row would be extracted twice.
+    pieces = []
+    for block in text.split("\n\n"):
+        rows = [line for line in block.splitlines() if line.strip()]
+        if not rows:
+            continue
 
-def build_chunks(text: str, page_no: int, max_rows=30):
-    lines = text.splitlines()
-    chunks, buf = [], []
+        block = "\n".join(rows)
+        if len(block) <= max_chars:
+            pieces.append(block + "\n")
+            continue
 
-    for line in lines:
-        if line.strip():
-            buf.append(line)
+        for row in rows:
+            pieces.extend(row[i:i + max_chars] for i in range(0, len(row), max_chars))
 
-        if len(buf) >= max_rows:
-            chunks.append({"page": page_no, "text": "\n".join(buf)})
-            buf = []
+    chunks, buf, size = [], [], 0
+
+    for piece in pieces:
+        if buf and size + len(piece) > max_chars:
+            chunks.append({"page": page_no, "text": "\n".join(buf).strip()})
+            buf, size = [], 0
+
+        buf.append(piece)
+        size += len(piece) + 1
 
     if buf:
-        chunks.append({"page": page_no, "text": "\n".join(buf)})
+        chunks.append({"page": page_no, "text": "\n".join(buf).strip()})
 
     return chunks
 
-# SAFE JSON PARSER
 
-def safe_json_parse(text: str) -> List[Dict]:
-    try:
-        return json.loads(text)
-    except:
-        pass
+# Chunks with no year, four-digit or comma-grouped figure (covers, blank
+# pages, contents lists) hold no revenue or traffic facts and are never sent.
+_CONTENT_RE = re.compile(r"\d{4}|\d{1,3}(?:,\d{3})+")
 
-    match = re.search(r"\[\s*{.*?}\s*\]", text, re.DOTALL)
-    if match:
-        try:
-            return json.loads(match.group(0))
-        except:
-            return []
 
-    return []
+def has_content(chunk: Dict) -> bool:
+    return bool(_CONTENT_RE.search(chunk["text"]))
 
 
 # EXTRACTION PROMPT
@@ -219,82 +241,68 @@ Schema:
 """
 
 
-# LLM CALL
-
-def map_chunk_with_gemini(chunk: Dict) -> List[Dict]:
-    response = client.models.generate_content(
-        model=MODEL_NAME,
-        contents=[
-            SYSTEM_PROMPT,
-            f"TEXT:\n{chunk['text']}"
-        ]
-    )
-
-    return safe_json_parse(response.text)
-
-
-
-
 # PIPELINE
 
-def run_pipeline() -> List[Dict]:
-    all_rows = []
-
+async def run_pipeline() -> AsyncIterator[Dict]:
     with pdfplumber.open(PDF_PATH) as pdf:
         total_pages = len(pdf.pages)
-        end_page = END_PAGE or total_pages
 
-        print(f"PDF has {total_pages} pages")
-        print(f"Processing pages {START_PAGE} → {end_page}")
+    end_page = END_PAGE or total_pages
 
-        for page_no in range(START_PAGE, min(end_page, total_pages) + 1):
-            page = pdf.pages[page_no - 1]
+    print(f"PDF has {total_pages} pages")
+    print(f"Processing pages {START_PAGE} → {end_page}")
 
-            tables = page.extract_tables()
-            if tables:
-                text = tables_to_text(tables)
-            else:
-                text = page.extract_text()
-                if not text or len(text.strip()) < 50:
-                    text = ocr_page(PDF_PATH, page_no)
+    page_nos = list(range(START_PAGE, min(end_page, total_pages) + 1))
 
+    async def content_chunks(pages: AsyncIterable[Tuple[int, str]]) -> AsyncIterator[Dict]:
+        async for page_no, text in pages:
             if not text:
                 continue
 
             chunks = build_chunks(text, page_no)
-            print(f"Page {page_no} → {len(chunks)} table chunks")
+            kept = [c for c in chunks if has_content(c)]
+            print(f"Page {page_no} → {len(chunks)} table chunks, {len(kept)} with figures")
 
-            for chunk in chunks:
-                rows = map_chunk_with_gemini(chunk)
-                print(f"  Chunk → {len(rows)} rows")
+            for chunk in kept:
+                yield chunk
 
-                for r in rows:
-                    r.setdefault("asset_type", ASSET_TYPE)
-                    r.setdefault("agency", AGENCY)
-                    r.setdefault("source_url", SOURCE_URL)
+    # pages, chunks and batches are produced lazily and map_batches keeps a
+    # bounded window in flight, so the first request goes out as soon as the
+    # first page is read and rows still come out in page order
+    pages = iter_page_texts(PDF_PATH, page_nos, extract_page_payload)
+    batches = build_batches(content_chunks(pages))
+    seen = OrderedDict()
 
-                all_rows.extend(rows)
+    async for batch, results in map_batches(SYSTEM_PROMPT, batches):
+        for chunk, rows in zip(batch, results):
+            print(f"  Page {chunk['page']} chunk → {len(rows)} rows")
 
-    return all_rows
+            for r in rows:
+                r.setdefault("asset_type", ASSET_TYPE)
+                r.setdefault("agency", AGENCY)
+                r.setdefault("source_url", SOURCE_URL)
 
+                key = row_key(r, OUTPUT_FIELDS)
+                if key in seen:
+                    seen.move_to_end(key)
+                    continue
 
-# SAVE OUTPUT
+                seen[key] = None
+                if len(seen) > DEDUP_WINDOW:
+                    seen.popitem(last=False)
 
-def save_output(rows: List[Dict]):
-    if not rows:
-        print("No records extracted")
-        return
+                yield r
 
-    df = pd.DataFrame(rows)
-    df = df.drop_duplicates()
-    df.to_csv(OUTPUT_CSV, index=False)
 
-    print(f"Extracted {len(df)} rows")
-    print(f"Saved to {OUTPUT_CSV}")
+# MAIN
 
+async def main():
+    try:
+        await save_output(run_pipeline(), OUTPUT_CSV, OUTPUT_FIELDS)
+    finally:
+        await delete_prompt_caches()
+        close_response_cache()
 
-# MAIN
 
 if __name__ == "__main__":
-    data = run_pipeline()
-    save_output(data)
+    asyncio.run(main())